@@ -1,46 +1,53 @@
 import asyncio
+import hashlib
+import os
+import re
+from argparse import ArgumentParser
+from functools import cached_property
 from pathlib import Path
 from textwrap import dedent
-from typing import cast, Literal
+from typing import Literal
+from urllib.parse import unquote
 
-from bs4 import BeautifulSoup
-from bs4.element import Tag
 import logfire
-from polars import DataFrame, Config
-from pydantic import BaseModel, TypeAdapter, computed_field
-from httpx import AsyncClient
-from pydantic_ai import Agent
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from polars import Config, DataFrame, SQLContext
+from pydantic import BaseModel, TypeAdapter, ValidationError, computed_field
+from pydantic_ai import Agent, ModelRetry, RunContext
 from rich.progress import Progress
+from selectolax.lexbor import LexborHTMLParser
 
 logfire.configure(scrubbing=False, console=False)
 logfire.instrument_pydantic_ai()
 logfire.instrument_httpx()
+logfire.instrument_aiohttp_client()
 
 
-class MP(BaseModel):
+Party = Literal['Conservative', 'Labour', 'Liberal Democrat', 'Other']
+PARTY_RE = re.compile(r'conservative|labour|liberal democrat', re.I)
+PARTIES: dict[str, Party] = {'conservative': 'Conservative', 'labour': 'Labour', 'liberal democrat': 'Liberal Democrat'}
+
+
+class MP(BaseModel, frozen=True):
     id: int
     name: str
     url: str
     raw_party: str
 
     @computed_field
-    @property
-    def party(self) -> Literal['Conservative', 'Labour', 'Liberal Democrat', 'Other']:
-        raw_party = self.raw_party.lower()
-        if 'conservative' in raw_party:
-            return 'Conservative'
-        elif 'labour' in raw_party:
-            return 'Labour'
-        elif 'liberal democrat' in raw_party:
-            return 'Liberal Democrat'
-        else:
-            return 'Other'
+    @cached_property
+    def party(self) -> Party:
+        m = PARTY_RE.search(self.raw_party)
+        return PARTIES[m.group(0).lower()] if m else 'Other'
 
 
 mps_ta = TypeAdapter(list[MP])
 
 
-class PoliticalRelation(BaseModel, use_attribute_docstrings=True):
+ANCESTOR_RELATIONS = frozenset({'father', 'mother', 'uncle', 'aunt', 'grandparent etc.'})
+
+
+class PoliticalRelation(BaseModel, use_attribute_docstrings=True, frozen=True):
     """Family member who was either a member of parliament a local councilor, or otherwise a politician."""
 
     name: str
@@ -53,104 +60,320 @@ class PoliticalRelation(BaseModel, use_attribute_docstrings=True):
     """Political party of the family member"""
 
     def is_ancestor(self) -> bool:
-        return self.relation in {'father', 'mother', 'uncle', 'aunt', 'grandparent etc.'}
+        return self.relation in ANCESTOR_RELATIONS
 
 
-class MPRelations(MP):
+class MPRelations(MP, frozen=True):
     relations: list[PoliticalRelation]
 
     @computed_field
-    @property
+    @cached_property
     def political_relations_count(self) -> int:
         return len(self.relations)
 
     @computed_field
-    @property
+    @cached_property
     def political_ancestor_count(self) -> int:
         return sum(r.is_ancestor() for r in self.relations)
 
 
 mp_relations_ta = TypeAdapter(list[MPRelations])
 
-mps_ta = TypeAdapter(list[MP])
 
+async def get_mps(session: ClientSession, indent: int | None = None) -> list[MP]:
+    mps_path = Path('mps.json')
+    if mps_path.exists():
+        mps = mps_ta.validate_json(mps_path.read_bytes())
+        if indent is not None:
+            mps_path.write_bytes(mps_ta.dump_json(mps, indent=indent))
+        return mps
 
-async def get_mps(client: AsyncClient) -> list[MP]:
     html = await get_html(
-        client, 'https://en.wikipedia.org/wiki/List_of_MPs_elected_in_the_2024_United_Kingdom_general_election'
+        session, 'https://en.wikipedia.org/wiki/List_of_MPs_elected_in_the_2024_United_Kingdom_general_election'
     )
 
-    soup = BeautifulSoup(html, 'html.parser')
-    mps_table = soup.find(id='elected-mps')
-    assert isinstance(mps_table, Tag), 'Table not found'
-    table_body = mps_table.find('tbody')
-    assert isinstance(table_body, Tag), 'Table body not found'
+    tree = LexborHTMLParser(html)
+    table_body = tree.css_first('#elected-mps tbody')
+    assert table_body is not None, 'Table body not found'
     mps: list[MP] = []
-    for i, row in enumerate(table_body.find_all('tr')):
-        assert isinstance(row, Tag), 'Row not found'
-        cells = cast(list[Tag], row.find_all('td'))
+    for i, row in enumerate(table_body.css('tr')):
+        cells = row.css('td')
         if len(cells) > 5:
-            mp_a = cells[3].find_all('a')[-1]
-            assert isinstance(mp_a, Tag)
-            path = mp_a['href']
+            mp_a = cells[3].css('a')[-1]
+            path = mp_a.attributes.get('href')
             assert path, 'Path not found'
-            name = mp_a.text.strip()
-            party_a = cells[5].find('a')
-            assert isinstance(party_a, Tag), 'Party not found'
-            party = party_a['title']
-            mp = MP(id=i, name=name, url=f'https://en.wikipedia.org/{path}', raw_party=party)  # type: ignore
+            name = mp_a.text().strip()
+            party_a = cells[5].css_first('a')
+            assert party_a is not None, 'Party not found'
+            party = party_a.attributes.get('title')
+            assert party, 'Party title not found'
+            mp = MP(id=i, name=name, url=f'https://en.wikipedia.org/{path}', raw_party=party)
             mps.append(mp)
 
+    mps_path.write_bytes(mps_ta.dump_json(mps, indent=indent))
     return mps
 
 
-agent = Agent(
-    'openai:gpt-4o',
-    result_type=list[PoliticalRelation],
-    system_prompt=dedent(
-        """
-        Your role is to inspect the contents the politician's wikipedia page and extract information
-        about any family members who were either a member of parliament a local councilor, or otherwise a politician.
-        """
-    ),
+MODEL = 'openai:gpt-4o'
+SYSTEM_PROMPT = dedent(
+    """
+    Your role is to inspect the contents of politicians' wikipedia pages and extract information
+    about any family members who were either a member of parliament a local councilor, or otherwise a politician.
+
+    The input contains the pages of several politicians, each wrapped in a tag of the form
+    <mp id="<id>" name="<name>">...</mp>. Only attribute relations found inside an MP's tag to that MP.
+    Return exactly one item for every MP id, with an empty list of relations if they have no politically
+    active family members.
+    """
 )
+# number of MPs whose pages are sent to the model in a single request
+BATCH_SIZE = 6
+# maximum number of characters of each page to include in the prompt
+MAX_PAGE_CHARS = 20_000
+# number of workers fetching pages from wikipedia
+WORKERS = 32
+# maximum number of concurrent requests to the model, kept below WORKERS to stay within rate limits
+llm_semaphore = asyncio.Semaphore(8)
+
+
+class BatchItem(BaseModel, use_attribute_docstrings=True):
+    mp_id: int
+    """ID of the MP, as given in the `id` attribute of the tag around their page"""
+    relations: list[PoliticalRelation]
+    """Politically active family members of the MP"""
 
 
-async def extract_relations(client: AsyncClient, raw_mps: list[MP]) -> list[MPRelations]:
-    mp_relations_path = Path('mp_relations.json')
+agent = Agent(MODEL, deps_type=set[int], result_type=list[BatchItem], system_prompt=SYSTEM_PROMPT)
+
+
+@agent.result_validator
+def check_batch_ids(ctx: RunContext[set[int]], result: list[BatchItem]) -> list[BatchItem]:
+    # compare sorted lists rather than sets so duplicate items are rejected too
+    returned_ids = sorted(item.mp_id for item in result)
+    if returned_ids != sorted(ctx.deps):
+        raise ModelRetry(f'Expected exactly one item for each of MP ids {sorted(ctx.deps)}, got {returned_ids}')
+    return result
+
+
+relations_ta = TypeAdapter(list[PoliticalRelation])
+llm_cache_dir = Path('.llm_cache')
+
+
+def llm_cache_path(text: str) -> Path:
+    key = hashlib.sha256(f'{MODEL}\x00{SYSTEM_PROMPT}\x00{text}'.encode()).hexdigest()
+    return llm_cache_dir / f'{key}.json'
+
+
+def read_llm_cache(cache_path: Path) -> list[PoliticalRelation] | None:
+    """Read a cached result, treating a missing or unreadable file as a cache miss."""
+    try:
+        return relations_ta.validate_json(cache_path.read_bytes())
+    except (FileNotFoundError, ValidationError):
+        return None
+
+
+def write_llm_cache(cache_path: Path, relations: list[PoliticalRelation]) -> None:
+    # write to a temporary file and rename it into place, so a crash can't leave a truncated cache file
+    tmp_path = cache_path.with_suffix('.tmp')
+    tmp_path.write_bytes(relations_ta.dump_json(relations))
+    os.replace(tmp_path, cache_path)
+
+
+async def cached_agent_run(pages: list[tuple[MP, str]]) -> dict[int, list[PoliticalRelation]]:
+    """Extract relations for a batch of MPs in one agent run, caching results on disk.
+
+    Each MP's result is cached separately, keyed by model, system prompt and page text, so only MPs not already
+    in the cache are sent to the model.
+    """
+    relations: dict[int, list[PoliticalRelation]] = {}
+    misses: list[tuple[MP, str]] = []
+    for mp, text in pages:
+        cached = read_llm_cache(llm_cache_path(text))
+        if cached is None:
+            misses.append((mp, text))
+        else:
+            relations[mp.id] = cached
+
+    if misses:
+        prompt = '\n\n'.join(f'<mp id="{mp.id}" name="{mp.name}">\n{text}\n</mp>' for mp, text in misses)
+        async with llm_semaphore:
+            r = await agent.run(prompt, deps={mp.id for mp, _ in misses})
+        llm_cache_dir.mkdir(exist_ok=True)
+        batch_relations = {item.mp_id: item.relations for item in r.data}
+        for mp, text in misses:
+            relations[mp.id] = batch_relations[mp.id]
+            write_llm_cache(llm_cache_path(text), batch_relations[mp.id])
+    return relations
+
+
+SECTION_HEADING_RE = re.compile(r'^(==+)\s*(.+?)\s*==+$', re.M)
+RELEVANT_SECTION_RE = re.compile(r'early life|personal|family|background', re.I)
+
+
+def relevant_text(text: str) -> str:
+    """Reduce an article to its lead and the sections (with their subsections) likely to mention family members.
+
+    Falls back to the start of the article if no relevant sections are found.
+    """
+    parts = SECTION_HEADING_RE.split(text)
+    kept = [parts[0].strip()]
+    # level of the relevant section we're currently inside, if any
+    keep_level: int | None = None
+    for marks, title, body in zip(parts[1::3], parts[2::3], parts[3::3]):
+        level = len(marks)
+        if keep_level is not None and level <= keep_level:
+            keep_level = None
+        if keep_level is None and RELEVANT_SECTION_RE.search(title):
+            keep_level = level
+        if keep_level is not None:
+            kept.append(f'{marks} {title} {marks}\n{body.strip()}')
+
+    if len(kept) == 1:
+        return text[:MAX_PAGE_CHARS]
+    return '\n\n'.join(kept)[:MAX_PAGE_CHARS]
+
+
+WIKIPEDIA_API_URL = 'https://en.wikipedia.org/w/api.php'
+
+
+def wiki_title(url: str) -> str:
+    return unquote(url.split('/wiki/', 1)[1])
+
+
+# in-flight article requests by title, so concurrent requests for the same article share a single response
+inflight_plaintext: dict[str, asyncio.Task[str]] = {}
+
+
+async def get_wiki_plaintext(session: ClientSession, title: str) -> str:
+    """Get the plain text of a wikipedia article, coalescing concurrent requests for the same title."""
+    task = inflight_plaintext.get(title)
+    if task is None:
+        task = asyncio.create_task(fetch_wiki_plaintext(session, title))
+        inflight_plaintext[title] = task
+        task.add_done_callback(lambda _: inflight_plaintext.pop(title, None))
+    # shield so one caller being cancelled doesn't cancel the request for everyone else waiting on it
+    return await asyncio.shield(task)
+
+
+async def fetch_wiki_plaintext(session: ClientSession, title: str) -> str:
+    """Get the plain text of a wikipedia article, avoiding downloading and parsing the rendered HTML."""
+    async with session.get(
+        WIKIPEDIA_API_URL,
+        params={
+            'action': 'query',
+            'prop': 'extracts',
+            'explaintext': 1,
+            'redirects': 1,
+            'format': 'json',
+            'formatversion': 2,
+            'titles': title,
+        },
+    ) as r:
+        r.raise_for_status()
+        data = await r.json()
+    (page,) = data['query']['pages']
+    assert 'extract' in page, f'No extract found for {title!r}'
+    return page['extract']
+
+
+async def extract_batch(session: ClientSession, mps: list[MP]) -> tuple[list[MPRelations], list[MP]]:
+    """Extract relations for a batch of MPs, returning the results and the MPs which failed.
+
+    Failures are isolated to individual MPs: a page which can't be fetched is left out of the batch, and if the
+    model fails on the batch as a whole, each page is retried on its own.
+    """
+    texts = await asyncio.gather(
+        *(get_wiki_plaintext(session, wiki_title(mp.url)) for mp in mps), return_exceptions=True
+    )
+    pages: list[tuple[MP, str]] = []
+    failed: list[MP] = []
+    for mp, text in zip(mps, texts):
+        if isinstance(text, BaseException):
+            print(f'Error fetching page for {mp.name}: {text!r}')
+            failed.append(mp)
+        else:
+            pages.append((mp, relevant_text(text)))
+
+    relations: dict[int, list[PoliticalRelation]] = {}
+    try:
+        relations = await cached_agent_run(pages)
+    except Exception as e:
+        print(f'Error extracting relations for {[mp.name for mp, _ in pages]}, retrying individually: {e!r}')
+        for page in pages:
+            try:
+                relations |= await cached_agent_run([page])
+            except Exception as e:
+                print(f'Error extracting relations for {page[0].name}: {e!r}')
+                failed.append(page[0])
+
+    extracted = [MPRelations(**mp.model_dump(), relations=relations[mp.id]) for mp, _ in pages if mp.id in relations]
+    return extracted, failed
+
+
+def load_mp_relations(mp_relations_path: Path, checkpoint_path: Path) -> list[MPRelations]:
+    """Load results from previous runs, including any checkpointed by a run which didn't complete."""
     if mp_relations_path.exists():
         mp_relations = mp_relations_ta.validate_json(mp_relations_path.read_bytes())
     else:
         mp_relations = []
+    done_ids = {r.id for r in mp_relations}
+    if checkpoint_path.exists():
+        complete, _, partial = checkpoint_path.read_bytes().rpartition(b'\n')
+        if partial:
+            # a crash mid-write leaves a partial last line, drop it so new results are appended to a clean file
+            checkpoint_path.write_bytes(complete + b'\n' if complete else b'')
+        for line in complete.splitlines():
+            mp_relation = MPRelations.model_validate_json(line)
+            if mp_relation.id not in done_ids:
+                mp_relations.append(mp_relation)
+                done_ids.add(mp_relation.id)
+    return mp_relations
 
-    async def extract_worker(queue: asyncio.Queue[MP]):
-        while True:
-            mp = await queue.get()
-            if any(mp.id == r.id for r in mp_relations):
-                queue.task_done()
-                progress.update(extract_task, advance=1)
-                continue
 
-            try:
-                html = await get_html(client, mp.url)
-                soup = BeautifulSoup(html, 'html.parser')
+async def extract_relations(session: ClientSession, raw_mps: list[MP], indent: int | None = None) -> list[MPRelations]:
+    mp_relations_path = Path('mp_relations.json')
+    # results are appended here as they're extracted, so they survive a crash and can be resumed
+    checkpoint_path = Path('mp_relations.jsonl')
+    mp_relations = load_mp_relations(mp_relations_path, checkpoint_path)
+    done_ids = {r.id for r in mp_relations}
 
-                body = soup.find(id='mw-content-text')
-                assert body is not None, f'Could not find body element in {mp.url}'
+    # MPs whose relations couldn't be extracted, they'll be retried on the next run
+    failed: list[MP] = []
+    # workers just count completed MPs, the progress bar is updated periodically by refresh_progress
+    completed = 0
 
-                r = await agent.run(body.text)
-            except Exception as e:
-                print(f'Error extracting relations for {mp}: {e}')
-                queue.task_done()
-                progress.update(extract_task, advance=1)
-                raise
-            else:
-                mp_relations.append(MPRelations(**mp.model_dump(), relations=r.data))
+    async def refresh_progress():
+        while True:
+            progress.update(extract_task, completed=completed)
+            await asyncio.sleep(0.25)
 
-                queue.task_done()
-                progress.update(extract_task, advance=1)
+    async def extract_worker(queue: asyncio.Queue[MP]):
+        nonlocal completed
+        while True:
+            batch = [await queue.get()]
+            while not queue.empty() and len(batch) < BATCH_SIZE:
+                batch.append(queue.get_nowait())
 
-    with Progress() as progress:
+            todo = [mp for mp in batch if mp.id not in done_ids]
+            try:
+                if todo:
+                    extracted, batch_failed = await extract_batch(session, todo)
+                    failed.extend(batch_failed)
+                    for mp_relation in extracted:
+                        mp_relations.append(mp_relation)
+                        done_ids.add(mp_relation.id)
+                        checkpoint.write(mp_relation.model_dump_json() + '\n')
+                    checkpoint.flush()
+            except Exception as e:
+                # keep the worker alive, the failure is reported once all MPs have been processed
+                print(f'Error extracting relations for {[mp.name for mp in todo]}: {e!r}')
+                failed.extend(mp for mp in todo if mp.id not in done_ids)
+            finally:
+                for _ in batch:
+                    queue.task_done()
+                completed += len(batch)
+
+    with checkpoint_path.open('a') as checkpoint, Progress() as progress:
         extract_task = progress.add_task('Extracting relations...', total=len(raw_mps))
 
         queue: asyncio.Queue[MP] = asyncio.Queue()
@@ -158,38 +381,55 @@ async def extract_relations(client: AsyncClient, raw_mps: list[MP]) -> list[MPRe
         for mp in raw_mps:
             queue.put_nowait(mp)
 
+        refresh_task = asyncio.create_task(refresh_progress())
         try:
-            tasks = [asyncio.create_task(extract_worker(queue)) for _ in range(12)]
+            tasks = [asyncio.create_task(extract_worker(queue)) for _ in range(WORKERS)]
             await queue.join()
             for task in tasks:
                 task.cancel()
+            if failed:
+                names = ', '.join(mp.name for mp in failed)
+                raise RuntimeError(f'Failed to extract relations for {len(failed)} MPs: {names}')
         finally:
+            refresh_task.cancel()
+            progress.update(extract_task, completed=completed)
             if mp_relations:
-                mp_relations_path.write_bytes(mp_relations_ta.dump_json(mp_relations, indent=2))
+                mp_relations_path.write_bytes(mp_relations_ta.dump_json(mp_relations, indent=indent))
 
+    # everything in the checkpoint is now in mp_relations.json
+    checkpoint_path.unlink()
     return mp_relations
 
 
-async def get_html(client: AsyncClient, url: str) -> str:
-    r = await client.get(url)
-    r.raise_for_status()
-    assert r.headers['content-type'].startswith('text/html'), f'Expected HTML content, got {r.headers["content-type"]}'
-    return r.text
+async def get_html(session: ClientSession, url: str) -> str:
+    async with session.get(url) as r:
+        r.raise_for_status()
+        assert r.content_type == 'text/html', f'Expected HTML content, got {r.content_type}'
+        return await r.text()
 
 
-async def main():
-    async with AsyncClient() as client:
+async def main(pretty: bool = False):
+    # JSON files are written compactly unless they're meant for reading
+    indent = 2 if pretty else None
+    async with ClientSession(
+        connector=TCPConnector(limit=64, limit_per_host=32, ttl_dns_cache=300, keepalive_timeout=60),
+        timeout=ClientTimeout(total=30, connect=10),
+        headers={'user-agent': 'uk-parliament-relatives/1.0'},
+    ) as session:
         with logfire.span('Getting list of MPs'):
-            raw_mps = await get_mps(client)
+            raw_mps = await get_mps(session, indent)
         with logfire.span('Extracting relations'):
-            mp_relations = await extract_relations(client, raw_mps)
+            mp_relations = await extract_relations(session, raw_mps, indent)
 
     df = DataFrame(
-        [
-            m.model_dump(include={'name', 'party', 'political_relations_count', 'political_ancestor_count'})
-            for m in mp_relations
-        ]
+        {
+            'name': [m.name for m in mp_relations],
+            'party': [m.party for m in mp_relations],
+            'political_relations_count': [m.political_relations_count for m in mp_relations],
+            'political_ancestor_count': [m.political_ancestor_count for m in mp_relations],
+        }
     )
+    ctx = SQLContext({'self': df.lazy()})
     with Config() as cfg:
         cfg.set_tbl_formatting('ASCII_MARKDOWN')
         all_sql = """
@@ -199,7 +439,7 @@ select
   count(*) as mps
 from self
 """
-        print(df.sql(all_sql))
+        print(ctx.execute(all_sql).collect())
 
         party_sql = """
 select
@@ -211,8 +451,11 @@ from self
 group by party
 order by political_ancestor_percentage desc
 """
-        print(df.sql(party_sql))
+        print(ctx.execute(party_sql).collect())
 
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = ArgumentParser(description='Find UK MPs with politically active relatives.')
+    parser.add_argument('--pretty', action='store_true', help='indent mps.json and mp_relations.json')
+    args = parser.parse_args()
+    asyncio.run(main(pretty=args.pretty))